@@ -1,18 +1,228 @@
+import array
 import asyncio
-import gzip
-import io
+import hashlib
+import itertools
+import os
+import struct
 import zlib
 from contextlib import asynccontextmanager
 from pathlib import Path
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+try:
+    import liburing  # Optional: batched io_uring reads at startup (Linux 5.6+)
+except ImportError:
+    liburing = None
 
-# Pre-load all frames into memory
-frames_cache = []
+try:
+    import zstandard  # Optional: zstd content encoding, for clients that accept it
+except ImportError:
+    zstandard = None
+
+# Pre-compress the whole stream once for all clients, per content encoding, as (blob,
+# offsets) where `blob[offsets[i] : offsets[i + 1]]` is the chunk of frame i
+precompressed_streams: dict[str, tuple[bytes, array.array]] = {}
+
+# Trailers of gzip streams resumed mid-way, where `gzip_trailers[k]` is for frame k * 30
+gzip_trailers: list[bytes] = []
+
+# Compression starts afresh every 30 frames (0.5s), so streams can also start there
+SEEK_INTERVAL = 30
+
+GZIP_HEADER_SIZE = 10  # As written by zlib, i.e. without file name (nor other extras)
+GZIP_TRAILER_SIZE = 8
+
+
+def sse_event(html: bytes) -> bytes:
+    """Format (UTF-8 encoded) HTML as an SSE event"""
+
+    if b"\n" not in html:  # Most events are a single line, no need to split them
+        return b"data: " + html + b"\n\n"
+
+    return b"".join(b"data: " + line + b"\n" for line in html.splitlines()) + b"\n"
+
+
+RESTART_EVENT = sse_event(
+    b'<htmx target="[sse-connect]" swap="outerHTML">'
+    b'<div sse-connect="/stream?start=0" sse-swap="message"></div>'
+    b"</htmx>"
+)
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    """Check if the client accepts `encoding` (listed in Accept-Encoding, not q=0)"""
+
+    for value in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = value.partition(";")
+
+        if name.strip().lower() == encoding:
+            try:
+                return float(params.strip().removeprefix("q=") or 1) > 0
+            except ValueError:
+                return True
+
+    return False
+
+
+def precompress(
+    encoding: str, events: bytes, offsets: array.array, level: int
+) -> tuple[bytes, array.array]:
+    """Compress the stream from the start, as one chunk per frame plus the restart"""
+
+    events = memoryview(events)  # Slice it without copying
+    total = len(offsets) - 1
+    chunks = []
+
+    if encoding == "zstd":
+        # Each seek point begins a new zstd frame, which can be decompressed on its own
+        for seek_point in range(0, total, SEEK_INTERVAL):
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+            for i in range(seek_point, min(seek_point + SEEK_INTERVAL, total)):
+                chunks.append(
+                    compressor.compress(events[offsets[i] : offsets[i + 1]])
+                    + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+                )
+
+            chunks[-1] += compressor.flush()
+
+        chunks.append(zstandard.ZstdCompressor(level=level).compress(RESTART_EVENT))
+    else:
+        # A full flush before each seek point drops the history, so inflating can start there
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 31
+        )  # wbits=31: gzip wrapper
+
+        for i in range(total):
+            if (i + 1) % SEEK_INTERVAL == 0:
+                flush_mode = zlib.Z_FULL_FLUSH
+            else:
+                flush_mode = zlib.Z_SYNC_FLUSH
+
+            chunks.append(
+                compressor.compress(events[offsets[i] : offsets[i + 1]])
+                + compressor.flush(flush_mode)
+            )
+
+        chunks.append(compressor.compress(RESTART_EVENT) + compressor.flush())
+
+    chunk_offsets = array.array("q", [0, *itertools.accumulate(map(len, chunks))])
+    return b"".join(chunks), chunk_offsets
+
+
+def build_gzip_trailers(events: bytes, offsets: array.array) -> list[bytes]:
+    """Build the gzip trailers (CRC-32 & size) of streams starting at each seek point"""
+
+    events = memoryview(events)  # Slice it without copying
+    trailers = []
+
+    for seek_point in range(0, len(offsets) - 1, SEEK_INTERVAL):
+        data = events[offsets[seek_point] :]
+        checksum = zlib.crc32(RESTART_EVENT, zlib.crc32(data))
+        size = (len(data) + len(RESTART_EVENT)) & 0xFFFFFFFF
+
+        trailers.append(struct.pack("<II", checksum, size))
+
+    return trailers
+
+
+async def read_frames_threaded(frame_files: list[Path]) -> list[bytes]:
+    """Read frame files concurrently, so the open/read syscalls overlap"""
+
+    frames = [b""] * len(frame_files)
+    semaphore = asyncio.Semaphore(64)
+
+    async def load(i: int, frame_file: Path):
+        async with semaphore:
+            frames[i] = await asyncio.to_thread(frame_file.read_bytes)
+
+    await asyncio.gather(*(load(i, f) for i, f in enumerate(frame_files)))
+    return frames
+
+
+def read_frames_io_uring(frame_files: list[Path], batch_size: int = 256) -> list[bytes]:
+    """Read frame files with io_uring, submitting a whole batch of reads at once"""
+
+    frames = []
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(batch_size, ring)
+
+    try:
+        # Batch to stay within the ring size and the open file descriptors limit
+        for offset in range(0, len(frame_files), batch_size):
+            fds = []
+            try:
+                # Opened one at a time, so a failing open still closes the earlier ones
+                for frame_file in frame_files[offset : offset + batch_size]:
+                    fds.append(os.open(frame_file, os.O_RDONLY))
+
+                buffers = [bytearray(os.fstat(fd).st_size) for fd in fds]
+
+                for i, (fd, buffer) in enumerate(zip(fds, buffers)):
+                    sqe = liburing.io_uring_get_sqe(ring)
+                    liburing.io_uring_prep_read(sqe, fd, buffer)
+                    liburing.io_uring_sqe_set_data64(sqe, i)
+
+                liburing.io_uring_submit(ring)
+
+                for _ in buffers:
+                    liburing.io_uring_wait_cqe(ring, cqe)
+                    i, size = cqe[0].user_data, liburing.trap_error(cqe[0].res)
+                    liburing.io_uring_cq_advance(ring, 1)
+
+                    if size != len(buffers[i]):
+                        raise OSError(f"Short read from {frame_files[offset + i]}")
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+            frames.extend(map(bytes, buffers))
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+    return frames
+
+
+async def read_frames(frame_files: list[Path]) -> list[bytes]:
+    """Read frame files, with io_uring if available, else with a thread pool"""
+
+    if liburing is not None and not liburing.linux_version_check(5.6):
+        try:
+            return await asyncio.to_thread(read_frames_io_uring, frame_files)
+        except OSError:  # e.g. io_uring blocked by seccomp (Docker's default profile)
+            pass
+
+    return await read_frames_threaded(frame_files)
+
+
+def render_events(frames: list[bytes]) -> tuple[bytes, array.array]:
+    """Render the SSE events of all frames, as one blob and the offsets of each frame"""
+
+    total = len(frames)
+    events = bytearray()
+    offsets = array.array("q", [0])
+
+    for i, frame in enumerate(frames):
+        # Frames are the same for every client, so render their events only once
+        # (frames are ASCII art, so they're kept as raw bytes, no decoding/encoding),
+        # as a single event per frame: server-commands processes all its <htmx> tags
+        events += sse_event(
+            b'<htmx target="#frames" swap="textContent">%s</htmx>'
+            b'<htmx target="#progress-container" swap="innerHTML">'
+            b'<progress value="%d" max="%d"></progress>'
+            b"</htmx>"
+            b'<htmx target="#progress-text" swap="textContent">'
+            b"%.2f%% / 100%%"
+            b"</htmx>" % (frame, i + 1, total, (i + 1) / total * 100)
+        )
+        offsets.append(len(events))
+
+    return bytes(events), offsets
 
 
 @asynccontextmanager
@@ -21,14 +231,25 @@ async def lifespan(app: FastAPI):
     frames_dir = Path("frames")
     frame_files = sorted(frames_dir.glob("out*.jpg.txt")) if frames_dir.exists() else []
 
-    for frame_file in frame_files:
-        with open(frame_file, "r", encoding="utf-8") as f:
-            frames_cache.append(f.read())
+    # Render in a helper, so the raw frames and the scratch buffer are freed right away
+    # (locals here live on for the app's whole lifetime, while suspended at `yield`)
+    events, offsets = render_events(await read_frames(frame_files))
+
+    # Streams from the start are the same for every client, so compress them only once
+    precompressed_streams["gzip"] = precompress("gzip", events, offsets, level=9)
+    if zstandard is not None:
+        precompressed_streams["zstd"] = precompress("zstd", events, offsets, level=9)
+
+    # Streams resumed mid-way only differ by seek point, so build their trailers once too
+    gzip_trailers[:] = build_gzip_trailers(events, offsets)
+
+    del events, offsets  # Only the compressed streams are served, drop the rest
 
     yield  # Application runs here
 
     # Shutdown: Clean up
-    frames_cache.clear()
+    precompressed_streams.clear()
+    gzip_trailers.clear()
     print("Frames cache cleared")
 
 
@@ -43,71 +264,74 @@ templates = Jinja2Templates(directory="templates")
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    response = templates.TemplateResponse("index.html", {"request": request})
+
+    # The page only changes when its template is edited (and auto-reloaded), so hash
+    # every render, and returning viewers can revalidate their cached copy
+    etag = f'"{hashlib.sha256(response.body).hexdigest()}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+    if "*" in tags or etag in tags:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    return response
 
 
 @app.get("/stream")
-async def bad_apple_stream(start: float = 0.0):
+async def bad_apple_stream(request: Request, start: float = 0.0):
     """SSE endpoint for Bad Apple animation"""
 
+    if "zstd" in precompressed_streams and accepts_encoding(request, "zstd"):
+        encoding = "zstd"
+    else:
+        encoding = "gzip"
+
     async def generate():
         """Generate SSE stream for Bad Apple animation"""
 
-        buffer = io.BytesIO()
-        gzip_file = gzip.GzipFile(fileobj=buffer, mode="wb")
-
-        def sse(html: str) -> bytes:
-            """Format HTML as SSE event and compress it"""
-
-            payload = "".join(f"data: {line}\n" for line in html.splitlines()) + "\n"
-            gzip_file.write(payload.encode("utf-8"))
-            gzip_file.flush(zlib.Z_SYNC_FLUSH)
-            compressed = buffer.getvalue()
-            buffer.seek(0)
-            buffer.truncate()
-            return compressed
-
         frame_duration = 1.0 / 60.0  # 60 FPS
-        total = len(frames_cache)
+        blob, offsets = precompressed_streams[encoding]
+        blob = memoryview(blob)  # Slice it without copying, it's shared by all clients
+        total = len(offsets) - 2  # Chunks of all frames, then of the restart
 
         # Calculate starting frame based on percentage
         start_frame = int((start / 100.0) * total)
         start_frame = max(0, min(start_frame, total - 1))  # Clamp to valid range
 
-        for i in range(start_frame, total):
-            frame = frames_cache[i]
-            progress = (i + 1) / total * 100
+        # Replay the pre-compressed stream, from the closest seek point (at or before)
+        start_frame -= start_frame % SEEK_INTERVAL
 
-            yield sse(
-                f'<htmx target="#frames" swap="textContent">{frame}</htmx>',
-            )
-            yield sse(
-                f'<htmx target="#progress-container" swap="innerHTML">'
-                f'<progress value="{i + 1}" max="{total}"></progress>'
-                f"</htmx>",
-            )
-            yield sse(
-                f'<htmx target="#progress-text" swap="textContent">'
-                f"{progress:.2f}% / 100%"
-                f"</htmx>",
-            )
+        # gzip is a single member, so it needs its header when starting mid-way...
+        resumed_gzip = encoding == "gzip" and start_frame > 0
+        if resumed_gzip:
+            yield blob[:GZIP_HEADER_SIZE]
 
-            await asyncio.sleep(frame_duration)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
 
-        # Restart from beginning
-        yield sse(
-            '<htmx target="[sse-connect]" swap="outerHTML">'
-            '<div sse-connect="/stream?start=0" sse-swap="message"></div>'
-            "</htmx>"
-        )
+        for i in range(start_frame, total):
+            yield blob[offsets[i] : offsets[i + 1]]
+
+            # Schedule on absolute deadlines, so time spent sending doesn't add up
+            deadline += frame_duration
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
 
-        gzip_file.close()
+        # Restart from beginning (the last slice)
+        if resumed_gzip:
+            # ...and a trailer matching what was actually sent
+            trailer = gzip_trailers[start_frame // SEEK_INTERVAL]
+            yield bytes(blob[offsets[total] : -GZIP_TRAILER_SIZE]) + trailer
+        else:
+            yield blob[offsets[total] :]
 
     return StreamingResponse(
         generate(),
         media_type="text/event-stream",
         headers={
-            "Content-Encoding": "gzip",
+            "Content-Encoding": encoding,
+            "Vary": "Accept-Encoding",
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no",  # Disable nginx/proxy buffering